@@ -1,5 +1,5 @@
 """SAT Certificate Lookup package."""
 
 from .config import DEFAULT_URL, DEFAULT_INPUT, DEFAULT_OUTPUT
-from .captcha_solver import solve_captcha
+from .captcha_solver import solve_captcha, record_result, CaptchaSolveError
 from .sat_certificate_lookup import create_driver, lookup_rfc, parse_certificates, process_rfcs
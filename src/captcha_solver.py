@@ -1,17 +1,96 @@
 """Captcha solving using LLM APIs (OpenAI or Anthropic)."""
 
+import asyncio
+import atexit
 import base64
+import hashlib
 import os
-from config import CAPTCHA_PROMPTS, PROMPT_NAMES
+import re
+import shelve
+import threading
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from config import (
+    CAPTCHA_PROMPTS, PROMPT_NAMES, CAPTCHA_CACHE_PATH,
+    CAPTCHA_BATCH_SIZE, CAPTCHA_BATCH_WAIT,
+)
+
+_REFUSAL_RE = re.compile(r"sorry|can't|cannot|unable|assist|help", re.IGNORECASE)
 
 _prompt_index = 0
+_cache = None
+_cache_lock = threading.Lock()
+# Per-session memory of images no prompt could read and solutions the form rejected
+_unsolvable = set()
+_rejected = set()
+_batch_loop = None
+_batch_queue = None
+_batch_task = None
+_batch_lock = threading.Lock()
+
+
+class CaptchaSolveError(ValueError):
+    """Raised when no prompt produced a usable solution for an image."""
+
+
+def _get_cache():
+    """Open the persistent image-hash -> solution cache on first use."""
+    global _cache
+    if _cache is None:
+        CAPTCHA_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        _cache = shelve.open(str(CAPTCHA_CACHE_PATH), writeback=False)
+    return _cache
+
+
+def _image_key(image_bytes: bytes) -> str:
+    return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+
+def _preprocess(image_bytes: bytes) -> bytes:
+    """Binarize with Otsu's threshold and median-denoise to strip background noise."""
+    try:
+        img = np.asarray(Image.open(BytesIO(image_bytes)).convert("L"))
+        hist = np.bincount(img.ravel(), minlength=256).astype(np.float64)
+        weight = np.cumsum(hist)
+        mean = np.cumsum(hist * np.arange(256))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            between = (mean[-1] * weight - mean * weight[-1]) ** 2 / (weight * (weight[-1] - weight))
+        threshold = np.nanargmax(between)
+        binary = Image.fromarray(np.where(img > threshold, 255, 0).astype(np.uint8))
+        out = BytesIO()
+        binary.filter(ImageFilter.MedianFilter(3)).save(out, format="PNG", optimize=True)
+        return out.getvalue()
+    except Exception:
+        # Uniform or unreadable images: let the LLM see the original
+        return image_bytes
 
 
 def _encode_base64(image_bytes: bytes) -> str:
     return base64.b64encode(image_bytes).decode("utf-8")
 
 
-def _solve_openai(image_bytes: bytes, prompt: str) -> str:
+def _batch_prompt(prompt: str, count: int) -> str:
+    if count == 1:
+        return prompt
+    return (f"{prompt}\nThere are {count} images. Solve each one in order and "
+            "output one answer per line, nothing else.")
+
+
+def _split_responses(text: str, count: int) -> list[str]:
+    if count == 1:
+        return [text.strip()]
+    lines = [line.strip() for line in text.strip().splitlines() if line.strip()]
+    if len(lines) != count:
+        # Answers can't be matched to images; treat them all as invalid, not as an API error
+        print(f"    Expected {count} answers, got {len(lines)}")
+        return [""] * count
+    return lines
+
+
+def _solve_openai(b64_images: list[str], prompt: str) -> list[str]:
     from openai import OpenAI
     client = OpenAI()
     response = client.chat.completions.create(
@@ -19,64 +98,168 @@ def _solve_openai(image_bytes: bytes, prompt: str) -> str:
         messages=[{
             "role": "user",
             "content": [
-                {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{_encode_base64(image_bytes)}"}}
+                {"type": "text", "text": _batch_prompt(prompt, len(b64_images))},
+                *({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64_image}"}}
+                  for b64_image in b64_images)
             ]
         }],
-        max_completion_tokens=50
+        max_completion_tokens=50 * len(b64_images)
     )
-    return response.choices[0].message.content.strip()
+    return _split_responses(response.choices[0].message.content, len(b64_images))
 
 
-def _solve_anthropic(image_bytes: bytes, prompt: str) -> str:
+def _solve_anthropic(b64_images: list[str], prompt: str) -> list[str]:
     import anthropic
     client = anthropic.Anthropic()
     response = client.messages.create(
         model="claude-sonnet-4-20250514",
-        max_tokens=50,
+        max_tokens=50 * len(b64_images),
         messages=[{
             "role": "user",
             "content": [
-                {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": _encode_base64(image_bytes)}},
-                {"type": "text", "text": prompt}
+                *({"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": b64_image}}
+                  for b64_image in b64_images),
+                {"type": "text", "text": _batch_prompt(prompt, len(b64_images))}
             ]
         }]
     )
-    return response.content[0].text.strip()
+    return _split_responses(response.content[0].text, len(b64_images))
+
+
+async def _run_batch(solver, prompt: str, items: list):
+    try:
+        responses = await asyncio.to_thread(solver, [b64_image for b64_image, _ in items], prompt)
+        for (_, future), response in zip(items, responses):
+            future.set_result(response)
+    except Exception as e:
+        for _, future in items:
+            if not future.done():
+                future.set_exception(e)
+
+
+async def _batch_worker():
+    """Collect queued captchas into batches and send each same-prompt group in one request."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _batch_queue.get()]
+        deadline = loop.time() + CAPTCHA_BATCH_WAIT
+        while len(batch) < CAPTCHA_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        groups = {}
+        for solver, prompt, b64_image, future in batch:
+            groups.setdefault((solver, prompt), []).append((b64_image, future))
+        for (solver, prompt), items in groups.items():
+            loop.create_task(_run_batch(solver, prompt, items))
+
+
+async def _submit(solver, prompt: str, b64_image: str) -> str:
+    future = asyncio.get_running_loop().create_future()
+    await _batch_queue.put((solver, prompt, b64_image, future))
+    return await future
+
+
+def _stop_batch_loop():
+    _batch_task.cancel()
+    _batch_loop.call_soon_threadsafe(_batch_loop.stop)
+
+
+def _get_batch_loop():
+    """Start the background event loop that coalesces captcha requests."""
+    global _batch_loop, _batch_queue, _batch_task
+    with _batch_lock:
+        if _batch_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="captcha-batcher", daemon=True).start()
+            _batch_queue = asyncio.Queue()
+            _batch_task = asyncio.run_coroutine_threadsafe(_batch_worker(), loop)
+            _batch_loop = loop
+            atexit.register(_stop_batch_loop)
+    return _batch_loop
+
+
+def _solve_batched(solver, b64_image: str, prompt: str) -> str:
+    return asyncio.run_coroutine_threadsafe(_submit(solver, prompt, b64_image), _get_batch_loop()).result()
 
 
 def _is_valid_response(response: str) -> bool:
     if not response or len(response) > 15:
         return False
-    refusals = ["sorry", "can't", "cannot", "unable", "assist", "help"]
-    if any(r in response.lower() for r in refusals):
+    if _REFUSAL_RE.search(response):
         return False
     return bool(response.replace(" ", "").replace("-", "").replace("_", ""))
 
 
-def solve_captcha(image_bytes: bytes) -> str:
-    """Solve captcha with prompt rotation and fallback."""
+def solve_captcha(image_bytes: bytes, label: str = "") -> str:
+    """Solve captcha with prompt rotation and fallback.
+
+    `label` prefixes progress lines so parallel lookups can be told apart.
+    """
     global _prompt_index
+    tag = f"[{label}] " if label else ""
+    
+    key = _image_key(image_bytes)
+    with _cache_lock:
+        cached = _get_cache().get(key)
+        unsolvable = key in _unsolvable
+    if cached is not None:
+        print(f"  {tag}Using cached solution...")
+        return cached
+    if unsolvable:
+        raise CaptchaSolveError("Captcha already failed every prompt")
     
     if not os.environ.get("OPENAI_API_KEY") and not os.environ.get("ANTHROPIC_API_KEY"):
         raise ValueError("Set OPENAI_API_KEY or ANTHROPIC_API_KEY environment variable.")
     
+    b64_image = _encode_base64(_preprocess(image_bytes))
     use_openai = bool(os.environ.get("OPENAI_API_KEY"))
     api_name = "OpenAI" if use_openai else "Claude"
     solver = _solve_openai if use_openai else _solve_anthropic
+    last_error = None
     
     for attempt in range(len(CAPTCHA_PROMPTS)):
         idx = (_prompt_index + attempt) % len(CAPTCHA_PROMPTS)
-        print(f"  Using {api_name} with '{PROMPT_NAMES[idx]}' prompt...")
+        print(f"  {tag}Using {api_name} with '{PROMPT_NAMES[idx]}' prompt...")
         
         try:
-            response = solver(image_bytes, CAPTCHA_PROMPTS[idx])
+            response = _solve_batched(solver, b64_image, CAPTCHA_PROMPTS[idx])
             if _is_valid_response(response):
-                _prompt_index = (idx + 1) % len(CAPTCHA_PROMPTS)
-                return response
-            print(f"    Invalid response: '{response[:30]}...', trying next...")
+                with _cache_lock:
+                    rejected = (key, response) in _rejected
+                if not rejected:
+                    _prompt_index = (idx + 1) % len(CAPTCHA_PROMPTS)
+                    return response
+                print(f"    {tag}Already rejected: '{response}', trying next...")
+                continue
+            print(f"    {tag}Invalid response: '{response[:30]}...', trying next...")
         except Exception as e:
-            print(f"    Error: {e}, trying next...")
+            last_error = e
+            print(f"    {tag}Error: {e}, trying next...")
     
     _prompt_index = (_prompt_index + 1) % len(CAPTCHA_PROMPTS)
-    raise ValueError("All prompts failed")
+    if last_error is not None:
+        # An API failure says nothing about the image, so don't mark it unsolvable
+        raise last_error
+    with _cache_lock:
+        _unsolvable.add(key)
+    raise CaptchaSolveError("All prompts failed")
+
+
+def record_result(image_bytes: bytes, solution: str, accepted: bool):
+    """Cache a solution the form accepted; drop and remember it if the form rejected it."""
+    key = _image_key(image_bytes)
+    with _cache_lock:
+        cache = _get_cache()
+        if accepted:
+            cache[key] = solution
+        else:
+            _rejected.add((key, solution))
+            if key in cache:
+                del cache[key]
+        cache.sync()
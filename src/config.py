@@ -6,6 +6,7 @@ from pathlib import Path
 DEFAULT_URL = "https://portalsat.plataforma.sat.gob.mx/RecuperacionDeCertificados/faces/recuperaRFC.xhtml"
 DEFAULT_INPUT = Path(__file__).parent.parent / "input" / "rfcs.csv"
 DEFAULT_OUTPUT = Path(__file__).parent.parent / "outputs"
+CAPTCHA_CACHE_PATH = DEFAULT_OUTPUT / ".captcha_cache.db"
 
 # Captcha prompts (case-sensitive)
 CAPTCHA_PROMPTS = [
@@ -24,6 +25,17 @@ Whisper only the characters, no explanation.""",
 
 PROMPT_NAMES = ["ancient_scribe", "calligraphy_master", "oracle_vision"]
 
+# Captchas submitted within CAPTCHA_BATCH_WAIT seconds share one LLM request
+CAPTCHA_BATCH_SIZE = 4
+CAPTCHA_BATCH_WAIT = 0.05
+
+# Resources Chrome never downloads (the captcha image is the only asset we need).
+# Patterns match the whole URL, so the trailing * also catches query strings.
+BLOCKED_URL_PATTERNS = ["*.css*", "*.woff*", "*.ttf*", "*.svg*", "*sat_nuevo*"]
+
+# Explicit wait timeout (seconds) for page elements
+WAIT_TIMEOUT = 15
+
 # CSS selectors
 CAPTCHA_IMAGE_SELECTORS = ["img[src*='captcha']", "img[src*='Captcha']", "img[src*='jcaptcha']"]
 RFC_INPUT_SELECTORS = ["input[id='consultaCertificados:entradaRFC']", "input[id*='entradaRFC']", "input[id*='rfc']"]
@@ -12,11 +12,22 @@ from config import DEFAULT_URL, DEFAULT_INPUT, DEFAULT_OUTPUT
 from sat_certificate_lookup import process_rfcs
 
 
+def _positive_int(value: str) -> int:
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {n}")
+    return n
+
+
 def main():
     parser = argparse.ArgumentParser(description="Look up SAT certificates for RFCs.")
     parser.add_argument("-i", "--input", type=Path, default=DEFAULT_INPUT, help="CSV with RFCs")
     parser.add_argument("-o", "--output", type=Path, default=DEFAULT_OUTPUT, help="Output directory")
     parser.add_argument("--url", default=DEFAULT_URL, help="SAT page URL")
+    parser.add_argument("-w", "--workers", type=_positive_int, default=1, help="Parallel Chrome drivers")
     args = parser.parse_args()
     
     if not args.input.exists():
@@ -24,7 +35,7 @@ def main():
         return 1
     
     try:
-        process_rfcs(args.input, args.output, args.url)
+        process_rfcs(args.input, args.output, args.url, args.workers)
         print("Done!")
         return 0
     except Exception as e:
@@ -1,71 +1,160 @@
 """Core library for RFC certificate lookup with captcha solving."""
 
+import base64
 import csv
-import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from operator import itemgetter
 from pathlib import Path
 
 from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
 
 from config import (
     CAPTCHA_IMAGE_SELECTORS, RFC_INPUT_SELECTORS,
-    CAPTCHA_INPUT_SELECTORS, SEARCH_BUTTON_SELECTORS, CSV_FIELDNAMES,
+    CAPTCHA_INPUT_SELECTORS, SEARCH_BUTTON_SELECTORS, CSV_FIELDNAMES, WAIT_TIMEOUT,
+    BLOCKED_URL_PATTERNS,
 )
-from captcha_solver import solve_captcha
+from captcha_solver import solve_captcha, record_result, CaptchaSolveError
+
+_CERT_ROWS = "tbody[id*='tablaCert:tbn'] > tr"
+_CERT_CELLS = "div.rf-edt-c-cnt"
+_REGRESAR = (By.XPATH, "//input[@value='Regresar']")
+_RESULTS_FORM = (By.CSS_SELECTOR, "form#resultados")
+# Matches any of the known captcha image selectors, not just the first
+_CAPTCHA_IMAGE = (By.CSS_SELECTOR, ", ".join(CAPTCHA_IMAGE_SELECTORS))
 
 
 class RunLogger:
-    """Logger that writes to file and prints to console."""
+    """Logger that appends to file as it goes and prints to console."""
     
     def __init__(self, run_dir: Path):
         self.log_file = run_dir / "run.log"
-        self.entries = []
+        # Line-buffered so a crash still leaves everything logged so far
+        self._fh = open(self.log_file, "a", encoding="utf-8", buffering=1)
+        self._lock = threading.Lock()
         self.log(f"Run started: {datetime.now().isoformat()}")
     
+    def _write(self, entry: str, console: str):
+        with self._lock:
+            self._fh.write(entry + "\n")
+            print(console)
+    
     def log(self, message: str):
-        entry = f"[{datetime.now().strftime('%H:%M:%S')}] {message}"
-        self.entries.append(entry)
-        print(message)
+        self._write(f"[{time.strftime('%H:%M:%S')}] {message}", message)
     
     def error(self, message: str):
-        entry = f"[{datetime.now().strftime('%H:%M:%S')}] ERROR: {message}"
-        self.entries.append(entry)
-        print(f"  ERROR: {message}")
+        self._write(f"[{time.strftime('%H:%M:%S')}] ERROR: {message}", f"  ERROR: {message}")
     
     def save(self):
         self.log(f"Run completed: {datetime.now().isoformat()}")
-        self.log_file.write_text("\n".join(self.entries), encoding="utf-8")
+        self._fh.close()
 
 
 def create_driver() -> webdriver.Chrome:
-    """Create headless Chrome WebDriver."""
+    """Create headless Chrome WebDriver that skips non-essential assets."""
     options = Options()
     for arg in ["--headless=new", "--no-sandbox", "--disable-dev-shm-usage", 
                 "--disable-gpu", "--window-size=1920,1080",
-                "--ignore-certificate-errors", "--ignore-ssl-errors"]:
+                "--ignore-certificate-errors", "--ignore-ssl-errors",
+                "--disable-features=TranslateUI,IsolateOrigins"]:
         options.add_argument(arg)
     options.add_argument("--user-agent=Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) Chrome/120.0.0.0")
-    return webdriver.Chrome(options=options)
+    # Return from driver.get at DOMContentLoaded; lookup_rfc waits for what it needs
+    options.page_load_strategy = "eager"
+    # Each worker thread owns its driver, so commands never contend for the
+    # connection to ChromeDriver and the default connection pool is enough.
+    driver = webdriver.Chrome(options=options)
+    # Block by URL pattern rather than disabling images so the captcha still loads
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+    return driver
+
+
+# Selector list -> selector that matched last time, tried first on later calls
+_winning_selectors: dict[tuple, str] = {}
 
 
 def _find_element(driver, selectors, check_displayed=True):
     """Find first matching element from selector list."""
-    for sel in selectors:
+    key = tuple(selectors)
+    winner = _winning_selectors.get(key)
+    ordered = [winner] + [sel for sel in selectors if sel != winner] if winner else selectors
+    for sel in ordered:
         try:
             el = driver.find_element(By.CSS_SELECTOR, sel)
             if el and (not check_displayed or el.is_displayed()):
+                _winning_selectors[key] = sel
                 return el
         except Exception:
             pass
     return None
 
 
-def _is_results_page(html: str) -> bool:
-    return BeautifulSoup(html, "html.parser").find("form", id="resultados") is not None
+def _wait_for(driver, condition) -> bool:
+    """Block until condition holds or WAIT_TIMEOUT elapses."""
+    try:
+        WebDriverWait(driver, WAIT_TIMEOUT).until(condition)
+        return True
+    except TimeoutException:
+        return False
+
+
+def _find_results_form(soup: BeautifulSoup):
+    return soup.find("form", id="resultados")
+
+
+def _on_results_page(driver) -> bool:
+    # Ask the live DOM instead of parsing page_source; parse_certificates parses it once
+    return bool(driver.find_elements(*_RESULTS_FORM))
+
+
+def _capture_element_png(driver, el) -> bytes:
+    """Screenshot just the element's box via CDP, without scrolling or cropping."""
+    x, y, width, height = driver.execute_script(
+        "const r = arguments[0].getBoundingClientRect();"
+        "return [r.x + window.scrollX, r.y + window.scrollY, r.width, r.height];", el)
+    shot = driver.execute_cdp_cmd("Page.captureScreenshot", {
+        "format": "png",
+        "clip": {"x": x, "y": y, "width": width, "height": height, "scale": 1},
+    })
+    return base64.b64decode(shot["data"])
+
+
+def _fetch_image_bytes(driver, el) -> bytes:
+    """Read the captcha's original bytes through the page session, falling back to a screenshot."""
+    # force-cache returns the copy the page already displayed instead of requesting a new challenge
+    b64 = driver.execute_async_script(
+        "const done = arguments[arguments.length - 1];"
+        "fetch(arguments[0].src, {cache: 'force-cache', credentials: 'include'})"
+        ".then(r => r.ok ? r.blob() : Promise.reject())"
+        ".then(b => { const f = new FileReader();"
+        " f.onload = () => done(f.result.split(',')[1]); f.readAsDataURL(b); })"
+        ".catch(() => done(null));", el)
+    if b64:
+        return base64.b64decode(b64)
+    return _capture_element_png(driver, el)
+
+
+def _return_to_form(driver) -> bool:
+    """Click 'Regresar' if present and wait for the fresh form; True once it is ready."""
+    try:
+        btn = driver.find_element(*_REGRESAR)
+        driver.execute_script("arguments[0].click()", btn)
+        return _wait_for(driver, EC.all_of(
+            EC.staleness_of(btn),
+            EC.presence_of_element_located(_CAPTCHA_IMAGE),
+        ))
+    except WebDriverException:
+        # Leave the form unconfirmed; the next attempt reloads the page
+        return False
 
 
 def lookup_rfc(driver, rfc: str, url: str, run_dir: Path, logger: RunLogger, max_retries: int = 5):
@@ -74,38 +163,50 @@ def lookup_rfc(driver, rfc: str, url: str, run_dir: Path, logger: RunLogger, max
     captchas_dir.mkdir(parents=True, exist_ok=True)
     
     last_captcha = None
+    # Tag every line with the RFC; with several workers their logs interleave
+    tag = f"[{rfc}]"
     
     for attempt in range(max_retries):
         if attempt > 0:
-            logger.log(f"  Retry {attempt}/{max_retries-1}...")
+            logger.log(f"  {tag} Retry {attempt}/{max_retries-1}...")
         
-        driver.get(url)
-        time.sleep(2)
+        # Reload only when the previous step did not leave a fresh form on screen
+        if not getattr(driver, "_on_form", False):
+            driver.get(url)
+            _wait_for(driver, EC.any_of(
+                EC.presence_of_element_located(_CAPTCHA_IMAGE),
+                EC.presence_of_element_located(_REGRESAR),
+            ))
+            _return_to_form(driver)
+        driver._on_form = False
         
-        # Click 'Regresar' if on results page
-        try:
-            btn = driver.find_element(By.XPATH, "//input[@value='Regresar']")
-            btn.click()
-            time.sleep(2)
-        except Exception:
-            pass
+        # With eager page loads the captcha may still be downloading. Query it by
+        # selector on each poll so an <img> replaced meanwhile can't go stale.
+        _wait_for(driver, lambda d: d.execute_script(
+            "const img = document.querySelector(arguments[0]);"
+            "return !!img && img.complete && img.naturalWidth > 0;", _CAPTCHA_IMAGE[1]))
         
         # Find and capture captcha
         captcha_el = _find_element(driver, CAPTCHA_IMAGE_SELECTORS, check_displayed=False)
         if not captcha_el:
-            logger.log("  Warning: No captcha found")
+            logger.log(f"  {tag} Warning: No captcha found")
             continue
         
-        last_captcha = captcha_el.screenshot_as_png
+        last_captcha = _fetch_image_bytes(driver, captcha_el)
         
         # Save captcha image
         captcha_path = captchas_dir / f"{rfc}_attempt{attempt+1}.png"
         captcha_path.write_bytes(last_captcha)
         
         # Solve captcha
-        logger.log("  Solving captcha...")
-        solution = solve_captcha(last_captcha)
-        logger.log(f"  Solution: {solution}")
+        logger.log(f"  {tag} Solving captcha...")
+        try:
+            solution = solve_captcha(last_captcha, label=rfc)
+        except CaptchaSolveError as e:
+            # Submitting a known-bad answer only wastes a round trip; reload for a new captcha
+            logger.log(f"  {tag} Skipping submit: {e}")
+            continue
+        logger.log(f"  {tag} Solution: {solution}")
         
         # Fill form
         rfc_input = _find_element(driver, RFC_INPUT_SELECTORS)
@@ -113,7 +214,7 @@ def lookup_rfc(driver, rfc: str, url: str, run_dir: Path, logger: RunLogger, max
         search_btn = _find_element(driver, SEARCH_BUTTON_SELECTORS)
         
         if not all([rfc_input, captcha_input, search_btn]):
-            logger.log("  Warning: Missing form elements")
+            logger.log(f"  {tag} Warning: Missing form elements")
             continue
         
         rfc_input.clear()
@@ -121,13 +222,26 @@ def lookup_rfc(driver, rfc: str, url: str, run_dir: Path, logger: RunLogger, max
         captcha_input.clear()
         captcha_input.send_keys(solution)
         search_btn.click()
-        time.sleep(3)
+        # Either the results form appears or the form re-renders with a new captcha
+        captcha_rerendered = EC.all_of(
+            EC.staleness_of(captcha_el),
+            EC.presence_of_element_located(_CAPTCHA_IMAGE),
+        )
+        submitted = _wait_for(driver, EC.any_of(
+            EC.presence_of_element_located(_RESULTS_FORM),
+            captcha_rerendered,
+        ))
         
-        html = driver.page_source
-        if _is_results_page(html):
-            logger.log("  ✓ Success")
+        if _on_results_page(driver):
+            record_result(last_captcha, solution, accepted=True)
+            logger.log(f"  {tag} ✓ Success")
+            html = driver.page_source
+            driver._on_form = _return_to_form(driver)
             return html, last_captcha
-        logger.log("  ✗ Captcha incorrect")
+        record_result(last_captcha, solution, accepted=False)
+        logger.log(f"  {tag} ✗ Captcha incorrect")
+        # The re-rendered form already carries a new captcha
+        driver._on_form = submitted
     
     logger.error(f"{rfc}: All {max_retries} captcha attempts failed")
     return driver.page_source, last_captcha
@@ -139,11 +253,10 @@ def parse_certificates(html: str, rfc: str) -> list[dict]:
         return {"rfc": rfc, "razon_social": "", "numero_serie": "", "estado": estado,
                 "tipo": "", "fecha_inicial": "", "fecha_final": "", "url_certificado": ""}
     
-    if not _is_results_page(html):
+    soup = BeautifulSoup(html, "lxml")
+    if _find_results_form(soup) is None:
         return [empty_cert("CAPTCHA_ERROR")]
     
-    soup = BeautifulSoup(html, "html.parser")
-    
     # Extract company name
     razon_social = ""
     table = soup.find("table", {"width": "100%"})
@@ -155,15 +268,9 @@ def parse_certificates(html: str, rfc: str) -> list[dict]:
                 break
     
     # Parse certificate rows
-    tbody = soup.find("tbody", id=re.compile(r"tablaCert:tbn"))
-    if not tbody:
-        cert = empty_cert("SIN CERTIFICADOS")
-        cert["razon_social"] = razon_social
-        return [cert]
-    
     certs = []
-    for row in tbody.find_all("tr"):
-        cells = row.find_all("div", class_="rf-edt-c-cnt")
+    for row in soup.select(_CERT_ROWS):
+        cells = row.select(_CERT_CELLS, limit=5)
         if len(cells) >= 5:
             link = cells[0].find("a")
             certs.append({
@@ -177,13 +284,15 @@ def parse_certificates(html: str, rfc: str) -> list[dict]:
                 "url_certificado": link.get("href", "") if link else ""
             })
     
-    return certs or [{"rfc": rfc, "razon_social": razon_social, "numero_serie": "",
-                      "estado": "SIN CERTIFICADOS", "tipo": "", "fecha_inicial": "",
-                      "fecha_final": "", "url_certificado": ""}]
+    if not certs:
+        cert = empty_cert("SIN CERTIFICADOS")
+        cert["razon_social"] = razon_social
+        return [cert]
+    return certs
 
 
-def process_rfcs(input_path: Path, output_dir: Path, url: str):
-    """Process all RFCs from CSV."""
+def process_rfcs(input_path: Path, output_dir: Path, url: str, workers: int = 1):
+    """Process all RFCs from CSV using a pool of Chrome drivers."""
     # Create run folder
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     run_dir = output_dir / f"run_{timestamp}"
@@ -196,46 +305,61 @@ def process_rfcs(input_path: Path, output_dir: Path, url: str):
     with open(input_path, newline="", encoding="utf-8") as f:
         rfcs = list(csv.DictReader(f))
     
-    logger.log(f"Processing {len(rfcs)} RFC(s)\n")
+    logger.log(f"Processing {len(rfcs)} RFC(s) with {workers} worker(s)\n")
     
-    all_certs = []
-    driver = create_driver()
+    # One driver per worker thread, created lazily and quit at the end
+    local = threading.local()
+    drivers = []
+    drivers_lock = threading.Lock()
     
+    def get_driver():
+        if not hasattr(local, "driver"):
+            local.driver = create_driver()
+            with drivers_lock:
+                drivers.append(local.driver)
+        return local.driver
+    
+    def process_one(i: int, rfc: str) -> list[dict]:
+        logger.log(f"[{i}] {rfc}")
+        try:
+            html, _ = lookup_rfc(get_driver(), rfc, url, run_dir, logger)
+            certs = parse_certificates(html, rfc)
+            for c in certs:
+                icon = "✓" if c["estado"] == "Activo" else "○"
+                logger.log(f"    {icon} [{i}] {c['numero_serie']} - {c['estado']}")
+            return certs
+        except Exception as e:
+            logger.error(f"{rfc}: {e}")
+            return [{"rfc": rfc, "razon_social": "", "numero_serie": "",
+                     "estado": f"ERROR: {e}", "tipo": "", "fecha_inicial": "",
+                     "fecha_final": "", "url_certificado": ""}]
+    
+    # Stream rows as each RFC completes so a crash keeps what was already found
+    csv_path = run_dir / "resultados.csv"
+    records = 0
     try:
-        for i, row in enumerate(rfcs, 1):
-            rfc = row.get("rfc", "").strip()
-            if not rfc:
-                continue
-            
-            logger.log(f"[{i}] {rfc}")
-            try:
-                html, _ = lookup_rfc(driver, rfc, url, run_dir, logger)
-                certs = parse_certificates(html, rfc)
-                all_certs.extend(certs)
-                
-                for c in certs:
-                    icon = "✓" if c["estado"] == "Activo" else "○"
-                    logger.log(f"    {icon} {c['numero_serie']} - {c['estado']}")
-                    
-            except Exception as e:
-                logger.error(f"{rfc}: {e}")
-                all_certs.append({"rfc": rfc, "razon_social": "", "numero_serie": "",
-                                  "estado": f"ERROR: {e}", "tipo": "", "fecha_inicial": "",
-                                  "fecha_final": "", "url_certificado": ""})
-            logger.log("")
-            if i < len(rfcs):
-                time.sleep(2)
+        with open(csv_path, "w", newline="", encoding="utf-8") as out, \
+                ThreadPoolExecutor(max_workers=workers) as executor:
+            # Plain csv.writer over tuples skips DictWriter's per-row dict checks
+            writer = csv.writer(out, quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(CSV_FIELDNAMES)
+            row_values = itemgetter(*CSV_FIELDNAMES)
+            futures = []
+            for i, row in enumerate(rfcs, 1):
+                rfc = row.get("rfc", "").strip()
+                if rfc:
+                    futures.append(executor.submit(process_one, i, rfc))
+            # Only this thread writes, so the writer needs no lock
+            for future in as_completed(futures):
+                certs = future.result()
+                writer.writerows(map(row_values, certs))
+                out.flush()
+                records += len(certs)
     finally:
-        driver.quit()
-    
-    # Save results CSV
-    if all_certs:
-        csv_path = run_dir / "resultados.csv"
-        with open(csv_path, "w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=CSV_FIELDNAMES)
-            writer.writeheader()
-            writer.writerows(all_certs)
-        logger.log(f"Results: {csv_path} ({len(all_certs)} records)")
+        for driver in drivers:
+            driver.quit()
+    
+    logger.log(f"Results: {csv_path} ({records} records)")
     
     # Save log
     logger.save()
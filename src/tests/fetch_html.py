@@ -40,21 +40,25 @@ class LegacySSLAdapter(HTTPAdapter):
         return super().init_poolmanager(*args, **kwargs)
 
 
+# Shared session so repeated fetches reuse the TCP/TLS connection to the server
+_session = requests.Session()
+_session.mount("https://", LegacySSLAdapter(pool_connections=10, pool_maxsize=10))
+_session.headers.update({
+    "User-Agent": (
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/120.0.0.0 Safari/537.36"
+    ),
+    "Connection": "keep-alive",
+})
+
+
 def fetch_html(url: str, timeout: int = 15) -> str:
     """Return the HTML for the given URL or raise an error."""
     import urllib3
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-    headers = {
-        "User-Agent": (
-            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
-            "AppleWebKit/537.36 (KHTML, like Gecko) "
-            "Chrome/120.0.0.0 Safari/537.36"
-        )
-    }
-    session = requests.Session()
-    session.mount("https://", LegacySSLAdapter())
-    resp = session.get(url, headers=headers, timeout=timeout, verify=False)
+    resp = _session.get(url, timeout=timeout, verify=False)
     resp.raise_for_status()
     return resp.text
 